@@ -3,13 +3,19 @@
 from __future__ import print_function
 import sys
 from time import sleep, time
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 import os
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 import errno
 import socket
-from select import select
+import signal
+import struct
+import tempfile
+import threading
+from bisect import bisect
+from contextlib import contextmanager
+from select import select, error as select_error
 import traceback
 from collections import deque, defaultdict, namedtuple
 try:
@@ -17,16 +23,35 @@ try:
 except ImportError:
     from Queue import Queue, Empty
 
-from spidev import SpiDev
-import RPi.GPIO as GPIO
-from nrf24 import NRF24
-import requests
+try:
+    from spidev import SpiDev
+    import RPi.GPIO as GPIO
+    from nrf24 import NRF24
+except ImportError:  # Not on a Pi, so only the replay and benchmark modes work.
+    SpiDev = GPIO = NRF24 = None
+try:
+    import requests
+    from requests.exceptions import RequestException
+except ImportError:  # Only needed to post readings to emoncms.
+    requests = None
+
+    class RequestException(Exception):
+        pass
 import json
+try:
+    import faulthandler
+except ImportError:
+    faulthandler = None
 
 
 PIPES = ([0xe7, 0xe7, 0xe7, 0xe7, 0xe7], [0xc2, 0xc2, 0xc2, 0xc2, 0xc2])
 CHANNEL = 0x20
 
+# Seconds each phase of the main loops may take before its stack is dumped.
+BOILER_BUDGETS = {'recv': 11, 'sensor': 1, 'commands': 2, 'transmit': 2}
+CONTROLLER_BUDGETS = {'recv': 11, 'sensor': 5, 'actions': 5, 'client': 15}
+LOOP_DEADLINE = 30
+
 
 class Button(object):
     def __init__(self, pins):
@@ -47,14 +72,22 @@ class Relay(object):
     def __init__(self, pins):
         self.pins = pins
         self.states = []
+        self.changed = []
+        # Held while changing states, since the watchdog's monitor thread
+        # may turn every relay off in the middle of a loop pass.
+        self.lock = threading.RLock()
         for pin in self.pins:
             GPIO.setup(pin, GPIO.OUT, initial=GPIO.HIGH)
             self.states.append(0)
+            self.changed.append(0)
 
     def output(self, pin, state):
         print("setting pin", pin, state and "on" or "off")
-        self.states[pin] = state
-        GPIO.output(self.pins[pin], not state)  # These devices are active-low.
+        with self.lock:
+            if bool(state) != bool(self.states[pin]):
+                self.changed[pin] = time()
+            self.states[pin] = state
+            GPIO.output(self.pins[pin], not state)  # These devices are active-low.
 
     def state(self, pin):
         return self.states[pin]
@@ -63,20 +96,126 @@ class Relay(object):
         pass  # this will be done later: GPIO.cleanup()
 
 
+class SimulatedRelay(Relay):
+    """A Relay which only remembers its states, for replaying event logs."""
+    def __init__(self, pins):
+        self.pins = pins
+        self.states = [0] * len(pins)
+        self.changed = [0] * len(pins)
+        self.lock = threading.RLock()
+
+    def output(self, pin, state):
+        with self.lock:
+            if bool(state) != bool(self.states[pin]):
+                self.changed[pin] = time()
+            self.states[pin] = state
+
+
+class RelayCommands(object):
+    """Coalesces relay commands and applies them once per loop pass.
+
+    Only the last state asked for each pin is kept, so a burst of commands
+    costs at most one GPIO write per pin.  A change is held back until the
+    relay has been in its current state for ``min_on`` or ``min_off``
+    seconds, which stops the boiler from short cycling.  Pending changes
+    are cancelled when the watchdog fails safe, so a stale command cannot
+    turn a relay back on once the loop recovers.
+    """
+    def __init__(self, relay, min_on=0, min_off=0):
+        self.relay = relay
+        self.min_on = min_on
+        self.min_off = min_off
+        self.pending = {}
+
+    def submit(self, pin, state):
+        if not 0 <= pin < len(self.relay.pins):
+            raise IndexError('no relay on pin %d' % pin)
+        self.pending[pin] = bool(state)
+
+    def state(self, pin):
+        """Return the state the pin will end up in, pending changes included."""
+        return int(self.pending.get(pin, self.relay.state(pin)))
+
+    def apply(self, now=None):
+        if now is None:
+            now = time()
+        with self.relay.lock:
+            for pin, state in sorted(self.pending.items()):
+                current = bool(self.relay.state(pin))
+                if state != current:
+                    left = self.relay.changed[pin] + (self.min_on if current else self.min_off) - now
+                    if left > 0:
+                        print("holding pin", pin, "on" if current else "off", "for another %.0fs" % left)
+                        continue
+                    self.relay.output(pin, state)
+                del self.pending[pin]
+
+    def cancel(self):
+        with self.relay.lock:
+            self.pending.clear()
+
+
 class Temperature(object):
-    def __init__(self, major=0, minor=0):
-        self.spi = SpiDev()
+    """A 13 bit SPI temperature sensor.
+
+    Each call to sample() reads the sensor at most once per ``period`` and
+    publishes the result in ``raw`` (the two bytes as sent over the radio)
+    and ``value`` (degrees C), so every consumer in a loop pass sees the same
+    reading.  With ``oversample`` > 1 a burst of reads is averaged in raw
+    counts, and ``value`` is converted from the rounded count so it always
+    matches ``raw``.  Reads are spaced by the sensor's conversion time, since
+    reading sooner returns the previous conversion again.
+    """
+    CONVERSION_TIME = 0.25
+
+    def __init__(self, major=0, minor=0, period=0, oversample=1,
+                 conversion_time=CONVERSION_TIME, spi=None):
+        self.spi = spi if spi is not None else SpiDev()
         self.spi.open(major, minor)
+        self.period = max(period, conversion_time)
+        self.oversample = oversample
+        self.conversion_time = conversion_time
+        self.tx = [0, 0]
+        self.raw = [0, 0]
+        self.value = None
+        self.last_sample = 0
+        self.last_read = 0
+
+    def sample(self):
+        if self.value is not None and time() - self.last_sample < self.period:
+            return self.value
+        total = 0
+        for i in range(self.oversample):
+            wait = self.last_read + self.conversion_time - time()
+            if wait > 0:
+                sleep(wait)
+            if i == 0:
+                # The period runs from the start of the burst, so a caller
+                # that reads once per period never gets the cached value.
+                self.last_sample = time()
+            total += self.counts(self.spi.xfer2(self.tx))
+            self.last_read = time()
+        # Round half up in integers; round() differs between Python 2 and 3.
+        count = (2 * total + self.oversample) // (2 * self.oversample)
+        self.raw[0] = count >> 5 & 0xff
+        self.raw[1] = count << 3 & 0xff
+        self.value = count * 0.0625
+        return self.value
 
     def rawread(self):
-        return self.spi.xfer2([0, 0])
+        self.sample()
+        return self.raw
 
     def read(self):
-        return self.calc_temp(self.rawread())
+        return self.sample()
 
     @staticmethod
-    def calc_temp(buf):
-        return (((buf[0] << 8) | buf[1]) >> 3) * 0.0625
+    def counts(buf):
+        return ((buf[0] << 8) | buf[1]) >> 3
+
+    @classmethod
+    def calc_temp(cls, buf):
+        return cls.counts(buf) * 0.0625
 
     def cleanup(self):
         self.spi.close()
@@ -88,52 +227,203 @@ class Temperature(object):
         self.cleanup()
 
 
+class Watchdog(object):
+    """Times the phases of a main loop and fails safe if the loop stalls.
+
+    Each phase is timed against its budget and recorded in a histogram.  If a
+    phase is still running when its budget expires faulthandler dumps every
+    thread's stack.  A monitor thread turns all relays off once the loop has
+    missed its deadline by more than ``failsafe`` seconds, then calls each
+    of ``on_trip`` with the relay lock still held.  When started by systemd
+    the loop also feeds the service watchdog.
+    """
+    BUCKETS = [0.001 * 2 ** i for i in range(16)]  # 1ms to 32s
+    POLL_INTERVAL = 1
+
+    def __init__(self, budgets, deadline, failsafe, relay=None):
+        self.budgets = budgets
+        self.deadline = deadline
+        self.failsafe = failsafe
+        self.relay = relay
+        self.histograms = defaultdict(lambda: [0] * (len(self.BUCKETS) + 1))
+        self.maxima = defaultdict(float)
+        self.overruns = defaultdict(int)
+        self.last_kick = time()
+        self.tripped = False
+        self.on_trip = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.monitor)
+        self.thread.daemon = True
+        self.notify_sock = None
+        self.notify_addr = os.environ.get('NOTIFY_SOCKET')
+        if self.notify_addr and self.notify_addr.startswith('@'):
+            self.notify_addr = '\0' + self.notify_addr[1:]
+
+    def start(self):
+        if self.notify_addr:
+            self.notify_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: print(self.report()))
+        signal.siginterrupt(signal.SIGUSR1, False)
+        self.last_kick = time()
+        self.thread.start()
+        self.notify('READY=1')
+
+    def notify(self, state):
+        if self.notify_sock is None:
+            return
+        try:
+            self.notify_sock.sendto(state.encode('ascii'), self.notify_addr)
+        except socket.error as exc:
+            print("sd_notify failed:", exc)
+
+    def record(self, name, elapsed):
+        self.histograms[name][bisect(self.BUCKETS, elapsed)] += 1
+        self.maxima[name] = max(self.maxima[name], elapsed)
+
+    @contextmanager
+    def phase(self, name):
+        budget = self.budgets.get(name)
+        if budget and faulthandler:
+            faulthandler.dump_traceback_later(budget, file=sys.stdout)
+        start = time()
+        try:
+            yield
+        finally:
+            if budget and faulthandler:
+                faulthandler.cancel_dump_traceback_later()
+            elapsed = time() - start
+            self.record(name, elapsed)
+            if budget and elapsed > budget:
+                self.overruns[name] += 1
+                print('\n', datetime.now(), "phase", name, "took", elapsed,
+                      "seconds, budget is", budget)
+
+    def kick(self):
+        """Mark the start of a loop iteration."""
+        now = time()
+        self.record('loop', now - self.last_kick)
+        self.last_kick = now
+        if self.tripped:
+            print('\n', datetime.now(), "loop has recovered, relays were left off.")
+            self.tripped = False
+        self.notify('WATCHDOG=1')
+
+    def monitor(self):
+        while not self.stopped.wait(self.POLL_INTERVAL):
+            late = time() - self.last_kick - self.deadline
+            if late > self.failsafe and not self.tripped:
+                self.tripped = True
+                print('\n', datetime.now(), "loop missed its deadline by", late,
+                      "seconds, turning all relays off.")
+                if faulthandler:
+                    faulthandler.dump_traceback(file=sys.stdout)
+                self.fail_safe()
+                sys.stdout.flush()
+
+    def fail_safe(self):
+        if self.relay is None:
+            return
+        with self.relay.lock:
+            for pin in range(len(self.relay.pins)):
+                self.relay.output(pin, False)
+            for callback in self.on_trip:
+                callback()
+
+    def report(self):
+        lines = []
+        for name in sorted(self.histograms):
+            counts = self.histograms[name]
+            buckets = ' '.join('<%gs:%d' % (bound, count)
+                               for bound, count in zip(self.BUCKETS + [float('inf')], counts)
+                               if count)
+            lines.append('%s n=%d max=%.3fs overruns=%d %s' %
+                         (name, sum(counts), self.maxima[name], self.overruns[name], buckets))
+        return '\n'.join(lines)
+
+    def cleanup(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.notify('STOPPING=1')
+        if self.notify_sock is not None:
+            self.notify_sock.close()
+        print(self.report())
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.cleanup()
+
+
+def open_radio(major, minor, ce_pin, irq_pin):
+    radio = NRF24()
+    radio.begin(major, minor, ce_pin, irq_pin)
+    radio.setDataRate(radio.BR_250KBPS)
+    radio.setChannel(CHANNEL)
+    radio.setAutoAck(1)
+    radio.enableDynamicPayloads()
+    radio.printDetails()
+    radio.openWritingPipe(PIPES[0])
+    radio.openReadingPipe(1, PIPES[1])
+    return radio
+
+
 class Boiler(object):
-    def __init__(self, major, minor, ce_pin, irq_pin, temperature, relay, button):
+    def __init__(self, radio, temperature, relay, button, watchdog, storage=None, min_on=0, min_off=0):
         self.relay = relay
+        self.commands = RelayCommands(relay, min_on, min_off)
         self.temperature = temperature
         self.button = button
-        self.radio = NRF24()
-        self.radio.begin(major, minor, ce_pin, irq_pin)
-        self.radio.setDataRate(self.radio.BR_250KBPS)
-        self.radio.setChannel(CHANNEL)
-        self.radio.setAutoAck(1)
-        self.radio.enableDynamicPayloads()
-        self.radio.printDetails()
-        self.radio.openWritingPipe(PIPES[0])
-        self.radio.openReadingPipe(1, PIPES[1])
+        self.watchdog = watchdog
+        watchdog.on_trip.append(self.commands.cancel)
+        self.storage = storage
+        self.radio = radio
 
     def run(self):
         while True:
+            self.watchdog.kick()
             try:
-                recv_buffer = self.recv(10)
-                print("recv_buffer", recv_buffer, "temp", self.temperature.read())
-                while True:
-                    try:
-                        event = self.button.events.get_nowait()
-                    except Empty:
-                        break
-                    else:
-                        recv_buffer.append(event)  # pin = 0, query = 0, state = event
-                for byte in recv_buffer:
-                    pin = byte >> 2
-                    query = byte >> 1 & 1
-                    state = byte & 1
-                    print("pin", pin, "query", query, "state", state)
-                    if query:
-                        self.radio.write([self.relay.state(pin)])
-                    else:
-                        self.relay.output(pin, state)
-                start = time()
-                result = self.radio.write(self.temperature.rawread())
-                if not result:
-                    print(datetime.now(), "Did not receive ACK from controller after", time() - start, "seconds:", self.radio.last_error)
-                arc = self.radio.read_register(self.radio.OBSERVE_TX)
-                if result and arc & 0xf != 0:
-                    print("Last TX succeeded in", arc & 0xf, "retransmissions.")
+                with self.watchdog.phase('recv'):
+                    recv_buffer = self.recv(10)
+                with self.watchdog.phase('sensor'):
+                    temp = self.temperature.sample()
+                    print("recv_buffer", recv_buffer, "temp", temp)
+                    if self.storage is not None:
+                        # The controller records this sensor as sensor 1.
+                        self.storage.write(sample('temperature_raw', datetime.now(), 1, temp))
+                with self.watchdog.phase('commands'):
+                    while True:
+                        try:
+                            event = self.button.events.get_nowait()
+                        except Empty:
+                            break
+                        else:
+                            recv_buffer.append(event)  # pin = 0, query = 0, state = event
+                    for byte in recv_buffer:
+                        pin = byte >> 2
+                        query = byte >> 1 & 1
+                        state = byte & 1
+                        print("pin", pin, "query", query, "state", state)
+                        if query:
+                            self.radio.write([self.commands.state(pin)])
+                        else:
+                            self.commands.submit(pin, state)
+                    self.commands.apply()
+                with self.watchdog.phase('transmit'):
+                    start = time()
+                    result = self.radio.write(list(self.temperature.raw))
+                    if not result:
+                        print(datetime.now(), "Did not receive ACK from controller after", time() - start, "seconds:", self.radio.last_error)
+                    arc = self.radio.read_register(self.radio.OBSERVE_TX)
+                    if result and arc & 0xf != 0:
+                        print("Last TX succeeded in", arc & 0xf, "retransmissions.")
+                sys.stdout.flush()
+            except Exception:
+                print('\n', datetime.now(), "Exception in boiler loop:")
+                traceback.print_exc()
                 sys.stdout.flush()
-            except Exception as exc:
-                print(exc)
 
     def recv(self, timeout=None):
         end = time() + timeout
@@ -152,6 +442,8 @@ class Boiler(object):
 
     def cleanup(self):
         self.radio.end()
+        if self.storage is not None:
+            self.storage.close()
 
     def __enter__(self):
         return self
@@ -162,115 +454,245 @@ class Boiler(object):
 
 action = namedtuple('action', 'metric value pin state')
 
+
+class ReplayError(Exception):
+    pass
+
+
+class EventLog(object):
+    """Compact binary log of every input the controller acts on.
+
+    Each record is a timestamp, an event kind and a length-prefixed payload.
+    TIMER, RADIO and COMMAND events drive the controller's handlers; SAMPLE,
+    ACK and REPLY record what the hardware returned while they ran, so a
+    replay can substitute them without touching the hardware.
+    """
+    HEADER = struct.Struct('<dBH')
+    START, TIMER, RADIO, COMMAND, SAMPLE, ACK, REPLY = range(1, 8)
+
+    def __init__(self, path):
+        self.f = open(path, 'ab')
+
+    def record(self, now, kind, payload=b''):
+        self.f.write(self.HEADER.pack(now, kind, len(payload)) + payload)
+        self.f.flush()
+
+    @classmethod
+    def read(cls, path):
+        """Yield (timestamp, kind, payload) for every event in a log."""
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(cls.HEADER.size)
+                if len(header) < cls.HEADER.size:
+                    return
+                now, kind, length = cls.HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length:
+                    return
+                yield now, kind, payload
+
+    def close(self):
+        self.f.close()
+
+
 class Controller(object):
-    def __init__(self, major, minor, ce_pin, irq_pin, temperature, db, sock, relay):
+    SAMPLE_INTERVAL = 10
+
+    def __init__(self, radio, temperature, db, sock, relay, watchdog, events=None, clock=time):
         self.temperature = temperature
         self.db = db
         self.sock = sock
         self.relay = relay
-        self.actions = []
-        self.radio = NRF24()
-        self.radio.begin(major, minor, ce_pin, irq_pin)
-        self.radio.setDataRate(self.radio.BR_250KBPS)
-        self.radio.setChannel(CHANNEL)
-        self.radio.setAutoAck(1)
-        self.radio.enableDynamicPayloads()
-        self.radio.printDetails()
-        self.radio.openWritingPipe(PIPES[0])
-        self.radio.openReadingPipe(1, PIPES[1])
+        self.watchdog = watchdog
+        self.events = events
+        self.clock = clock
+        self.replaying = None
+        self.radio = radio
+        self.handlers = {
+            EventLog.START: self.on_start,
+            EventLog.TIMER: self.on_timer,
+            EventLog.RADIO: self.on_radio,
+            EventLog.COMMAND: self.on_command,
+        }
+        self.on_start()
 
     def run(self):
         try:
-            tick = time()
+            self.dispatch(EventLog.START)
             while True:
-                recv_buffer = self.recv(10, rfds=[self.sock])
-
-                if recv_buffer and len(recv_buffer) == 2:
-                    self.db.write(1, self.temperature.calc_temp(recv_buffer))
-                if tick < time():
-                    tick = time() + 10
-                    temp = self.temperature.read()
-                    self.db.write(0, temp)
-
-                for i, (metric, value, pin, state) in enumerate(sorted(self.actions)):
-                    if metric == 'temp' and temp >= value or \
-                            metric == 'time' and time() >= value:
-                        del self.actions[i]
-                        result = self.control(pin, state)
-                        print('\n', datetime.now(), "action matched:", metric, value, pin, state, "=>", result)
-                        if not result:
-                            print('action failed, will retry in 10s.')
-                            self.actions.append(action(metric, value, pin, state))
-                        break
-                try:
-                    conn, _ = self.sock.accept()
-                except socket.error as exc:
-                    if exc.errno != errno.EAGAIN:
-                        raise
-                else:
+                self.watchdog.kick()
+                with self.watchdog.phase('recv'):
+                    recv_buffer = self.recv(10, rfds=[self.sock])
+
+                with self.watchdog.phase('sensor'):
+                    if recv_buffer:
+                        self.dispatch(EventLog.RADIO, bytes(bytearray(recv_buffer)))
+
+                with self.watchdog.phase('actions'):
+                    self.dispatch(EventLog.TIMER)
+
+                with self.watchdog.phase('client'):
                     try:
-                        conn.settimeout(10)
-                        recv_line = conn.recv(1024)
-                        args = recv_line[:-1].split(None, 2)
-                        if len(args) > 2:
-                            state, pin, arg = args
-                            pin = int(pin)
-                            if state == 'boost':
-                                args = arg.split()
-                                if len(args) == 2:
-                                    metric, value = args
-                                    value = float(value)
-                                    if metric == 'temp' and temp >= value:
-                                        conn.sendall('temperature already above target!\n')
-                                        continue
-                                    if metric == 'time' and value <= 0:
-                                        conn.sendall('time delta must be positive!\n')
-                                        continue
-                                    if metric == 'time':
-                                        value += time()
-                                    self.actions.append(action(metric, value, pin, 'off'))
-                                    print('\n', datetime.now(), "added action", self.actions)
-                                    state = 'on'  # continue to turn the boiler on
-                        else:
-                            state, pin = args
-                            pin = int(pin)
-                        if state.lower() in ('on', 'off'):
-                            result = self.control(pin, state)
-                        recv_buffer = ''  # Need to clear buffer each time through the loop.
-                        if state.lower() == 'query':
-                            result, recv_buffer = self.state(pin)
-                        elif state.lower() == 'queryactions':
-                            result = True
-                            recv_buffer = str(self.actions)
-                        if isinstance(recv_buffer, list):
-                            if not recv_buffer:
-                                recv_buffer = ''
-                            elif len(recv_buffer) == 1:
-                                recv_buffer = recv_buffer[0]
-                        conn.sendall('%s %s\n' % ('OK' if result else 'timed out', recv_buffer))
-                    except Exception as exc:
-                        print()
-                        print('\n', datetime.now(), "Exception while processing:", repr(recv_line))
-                        traceback.print_exc()
-                        if self.radio.last_error:
-                            print("Last radio error: %r" % self.radio.last_error)
+                        conn, _ = self.sock.accept()
+                    except socket.error as exc:
+                        if exc.errno != errno.EAGAIN:
+                            raise
+                    else:
                         try:
-                            conn.sendall('invalid request: {!s}\n'.format(exc))
-                        except socket.error:
-                            pass
-                    finally:
-                        conn.close()
+                            conn.settimeout(10)
+                            conn.sendall(self.dispatch(EventLog.COMMAND, conn.recv(1024)))
+                        except socket.error as exc:
+                            print('\n', datetime.now(), "Socket error while talking to client:", exc)
+                        finally:
+                            conn.close()
         except KeyboardInterrupt:
             print()
 
+    def replay(self, events):
+        """Feed recorded events through the controller with simulated time.
+
+        Hardware inputs are taken from the log instead of the devices, so no
+        radio, sensor or socket is needed.  Raises ReplayError if the
+        controller asks for a different input than was recorded, which means
+        its behaviour has changed since the log was made.
+        """
+        self.replaying = iter(events)
+        count = 0
+        for self.now, kind, payload in self.replaying:
+            if kind not in self.handlers:
+                raise ReplayError('unexpected event kind %d at %f' % (kind, self.now))
+            self.handlers[kind](payload)
+            count += 1
+        self.replaying = None
+        return count
+
+    def dispatch(self, kind, payload=b''):
+        self.now = self.clock()
+        self.record(kind, payload)
+        return self.handlers[kind](payload)
+
+    def record(self, kind, payload=b''):
+        if self.events is not None:
+            self.events.record(self.now, kind, payload)
+
+    def expect(self, kind):
+        """Return the payload of the next recorded event, which must be of kind."""
+        try:
+            now, got, payload = next(self.replaying)
+        except StopIteration:
+            raise ReplayError('log ended while waiting for event kind %d' % kind)
+        if got != kind:
+            raise ReplayError('expected event kind %d at %f, found %d' % (kind, now, got))
+        return payload
+
+    def date(self):
+        return datetime.fromtimestamp(self.now)
+
+    def on_start(self, payload=b''):
+        self.actions = []
+        self.tick = 0
+        self.temp = None
+
+    def on_radio(self, payload):
+        if len(payload) == 2:
+            self.db.write(1, Temperature.calc_temp(bytearray(payload)), self.date())
+
+    def on_timer(self, payload):
+        if self.tick < self.now:
+            self.tick = self.now + self.SAMPLE_INTERVAL
+            self.temp = self.read_temperature()
+            self.db.write(0, self.temp, self.date())
+
+        for i, (metric, value, pin, state) in enumerate(sorted(self.actions)):
+            if metric == 'temp' and self.temp >= value or \
+                    metric == 'time' and self.now >= value:
+                del self.actions[i]
+                result = self.control(pin, state)
+                print('\n', self.date(), "action matched:", metric, value, pin, state, "=>", result)
+                if not result:
+                    print('action failed, will retry in 10s.')
+                    self.actions.append(action(metric, value, pin, state))
+                break
+
+    def on_command(self, recv_line):
+        """Handle one line from the control socket and return the reply."""
+        if not isinstance(recv_line, str):
+            recv_line = recv_line.decode('ascii')  # Python 3 sockets return bytes.
+        try:
+            args = recv_line[:-1].split(None, 2)
+            if len(args) > 2:
+                state, pin, arg = args
+                pin = int(pin)
+                if state == 'boost':
+                    args = arg.split()
+                    if len(args) == 2:
+                        metric, value = args
+                        value = float(value)
+                        if metric == 'temp' and self.temp >= value:
+                            return 'temperature already above target!\n'
+                        if metric == 'time' and value <= 0:
+                            return 'time delta must be positive!\n'
+                        if metric == 'time':
+                            value += self.now
+                        self.actions.append(action(metric, value, pin, 'off'))
+                        print('\n', self.date(), "added action", self.actions)
+                        state = 'on'  # continue to turn the boiler on
+            else:
+                state, pin = args
+                pin = int(pin)
+            if state.lower() in ('on', 'off'):
+                result = self.control(pin, state)
+            recv_buffer = ''
+            if state.lower() == 'query':
+                result, recv_buffer = self.state(pin)
+            elif state.lower() == 'queryactions':
+                result = True
+                recv_buffer = str(self.actions)
+            if isinstance(recv_buffer, list):
+                if not recv_buffer:
+                    recv_buffer = ''
+                elif len(recv_buffer) == 1:
+                    recv_buffer = recv_buffer[0]
+            return '%s %s\n' % ('OK' if result else 'timed out', recv_buffer)
+        except ReplayError:
+            raise
+        except Exception as exc:
+            print()
+            print('\n', self.date(), "Exception while processing:", repr(recv_line))
+            traceback.print_exc()
+            if self.radio is not None and self.radio.last_error:
+                print("Last radio error: %r" % self.radio.last_error)
+            return 'invalid request: {!s}\n'.format(exc)
+
+    def read_temperature(self):
+        if self.replaying is not None:
+            return struct.unpack('<d', self.expect(EventLog.SAMPLE))[0]
+        temp = self.temperature.read()
+        self.record(EventLog.SAMPLE, struct.pack('<d', temp))
+        return temp
+
+    def radio_write(self, buf):
+        if self.replaying is not None:
+            return bool(struct.unpack('<B', self.expect(EventLog.ACK))[0])
+        result = self.radio.write(buf)
+        self.record(EventLog.ACK, struct.pack('<B', bool(result)))
+        return result
+
+    def radio_reply(self):
+        if self.replaying is not None:
+            return list(bytearray(self.expect(EventLog.REPLY)))
+        recv_buffer = self.recv(1)
+        self.record(EventLog.REPLY, bytes(bytearray(recv_buffer)))
+        return recv_buffer
+
     def state(self, pin):
         if pin < 0:
             return True, self.relay.state(-pin - 1)
         else:
             if self.control(pin, 'query'):
-                recv_buffer = self.recv(1)
+                recv_buffer = self.radio_reply()
                 return len(recv_buffer) > 0, recv_buffer
-            print("control returned not True: %r" % self.radio.last_error)
+            print("control returned not True: %r" % (self.radio and self.radio.last_error))
             return False, []
 
     def control(self, pin, state):
@@ -279,7 +701,7 @@ class Controller(object):
             return True
         else:
             cmd = pin << 2 | (state.lower() == 'query') << 1 | (state.lower() == 'on')
-            return self.radio.write(chr(cmd))
+            return self.radio_write(chr(cmd))
 
     def recv(self, timeout=None, rfds=None):
         if rfds is None:
@@ -290,7 +712,13 @@ class Controller(object):
         try:
             while not self.radio.available(pipe) and (timeout is None or time() < end):
                 #sleep(10000 / 1e6)
-                r, _, _ = select(rfds, [], [], 10000 / 1e6)
+                try:
+                    r, _, _ = select(rfds, [], [], 10000 / 1e6)
+                except select_error as exc:
+                    # select() is never restarted after a signal, even with siginterrupt().
+                    if exc.args[0] != errno.EINTR:
+                        raise
+                    continue
                 if r:
                     return []
             if self.radio.available(pipe):
@@ -302,10 +730,15 @@ class Controller(object):
             self.radio.stopListening()
 
     def cleanup(self):
-        self.radio.end()
+        if self.radio is not None:
+            self.radio.end()
         self.db.close()
-        self.temperature.cleanup()
-        self.sock.close()
+        if self.temperature is not None:
+            self.temperature.cleanup()
+        if self.sock is not None:
+            self.sock.close()
+        if self.events is not None:
+            self.events.close()
 
     def __enter__(self):
         return self
@@ -326,10 +759,79 @@ def tridian_slow(mylist):
     return sum(sorts[tri:2 * tri]) / float(tri)
 
 
-class DBWriter(object):
-    def __init__(self):
-        self.buf = defaultdict(deque)
-        self.con = sqlite3.connect('/var/lib/autoboiler/autoboiler.sqlite3')
+sample = namedtuple('sample', 'table date sensor temperature')
+
+EPOCH = datetime(1970, 1, 1)
+EMONCMS_URL = 'http://emonpi/emoncms/input/post.json?node=1&apikey=74f0ab98df349fdfd17559978fb1d4b9'
+
+
+def timestamp(date):
+    """Microseconds since 1970-01-01 for a naive local datetime."""
+    delta = date - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+class Storage(object):
+    """Base class for the places samples are stored.
+
+    Samples are buffered and handed to write_many() ``batch`` at a time, so
+    slow media see one write per batch rather than one per sample.  A batch
+    which fails to write is kept and retried with the next one, so
+    write_many() must leave nothing of a failed batch behind.
+    """
+    TABLES = ('temperature_raw', 'temperature')
+    MAX_PENDING = 10000  # samples kept for retry while writes are failing
+
+    def __init__(self, path, batch=1):
+        self.path = path
+        self.batch = batch
+        self.pending = []
+
+    def write(self, sample):
+        self.pending.append(sample)
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        try:
+            self.write_many(self.pending)
+        except Exception:
+            # Drop the oldest samples rather than grow without bound while
+            # the medium is failing.
+            keep = max(self.MAX_PENDING, self.batch)
+            if len(self.pending) > keep:
+                print('\n', datetime.now(), "dropping", len(self.pending) - keep,
+                      "unwritten samples")
+                del self.pending[:-keep]
+            raise
+        self.pending = []
+
+    def write_many(self, samples):
+        raise NotImplementedError
+
+    def query(self, table, sensor, start):
+        """Return (date, temperature) pairs for a sensor after start."""
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+
+class NullStorage(Storage):
+    """Discards every sample."""
+    def write_many(self, samples):
+        pass
+
+    def query(self, table, sensor, start):
+        return []
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, path, batch=1):
+        super(SQLiteStorage, self).__init__(path, batch)
+        self.con = sqlite3.connect(path, detect_types=sqlite3.PARSE_COLNAMES)
         self.con.isolation_level = None
         self.cur = self.con.cursor()
         self.cur.execute('''CREATE TABLE IF NOT EXISTS temperature
@@ -341,8 +843,156 @@ class DBWriter(object):
         self.cur.execute('''CREATE INDEX IF NOT EXISTS temperature_sensor_date
                           ON temperature(sensor, date)''')
 
-    def write(self, idx, value):
-        data = (datetime.now(), idx, value)
+    def write_many(self, samples):
+        self.cur.execute('BEGIN')
+        try:
+            for table in self.TABLES:
+                self.cur.executemany('insert into %s values (?, ?, ?)' % table,
+                                     [s[1:] for s in samples if s.table == table])
+            self.cur.execute('COMMIT')
+        except Exception:
+            try:
+                self.cur.execute('ROLLBACK')
+            except sqlite3.OperationalError:
+                pass  # SQLite already rolled the transaction back.
+            raise
+
+    def query(self, table, sensor, start):
+        self.flush()
+        self.cur.execute('select date as "date [timestamp]", temperature from %s '
+                         'where sensor = ? and date > ? order by date' % table,
+                         (sensor, start))
+        return self.cur.fetchall()
+
+    def close(self):
+        super(SQLiteStorage, self).close()
+        self.cur.close()
+        self.con.close()
+
+
+class FileStorage(Storage):
+    """Base class for backends which append encoded samples to a file.
+
+    The file is written unbuffered and a batch which fails part way through
+    is truncated away, so retrying it cannot leave torn or duplicate records.
+    """
+    def __init__(self, path, batch=1):
+        super(FileStorage, self).__init__(path, batch)
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def encode(self, samples):
+        raise NotImplementedError
+
+    def write_many(self, samples):
+        data = self.encode(samples)
+        offset = os.lseek(self.fd, 0, os.SEEK_END)
+        try:
+            written = 0
+            while written < len(data):
+                written += os.write(self.fd, data[written:])
+        except EnvironmentError:
+            os.ftruncate(self.fd, offset)
+            raise
+
+    def close(self):
+        super(FileStorage, self).close()
+        os.close(self.fd)
+
+
+class LogStorage(FileStorage):
+    """Append-only file of fixed size binary records, for the boiler node."""
+    RECORD = struct.Struct('<qBBf')  # timestamp, table, sensor, temperature
+
+    def encode(self, samples):
+        return b''.join(self.RECORD.pack(timestamp(s.date), self.TABLES.index(s.table),
+                                         s.sensor, s.temperature)
+                        for s in samples)
+
+    def query(self, table, sensor, start):
+        self.flush()
+        table, start = self.TABLES.index(table), timestamp(start)
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        result = []
+        for offset in range(0, len(data) - self.RECORD.size + 1, self.RECORD.size):
+            micros, t, s, temperature = self.RECORD.unpack_from(data, offset)
+            if t == table and s == sensor and micros > start:
+                result.append((EPOCH + timedelta(microseconds=micros), temperature))
+        return result
+
+
+class LineProtocolStorage(FileStorage):
+    """Appends samples as InfluxDB line protocol for export to other tools."""
+    def encode(self, samples):
+        return ''.join('%s,sensor=%d temperature=%r %d000\n' %
+                       (s.table, s.sensor, float(s.temperature), timestamp(s.date))
+                       for s in samples).encode('ascii')
+
+    def query(self, table, sensor, start):
+        self.flush()
+        tags = '%s,sensor=%d' % (table, sensor)
+        start = timestamp(start) * 1000
+        result = []
+        with open(self.path) as f:
+            for line in f:
+                key, field, nanos = line.split()
+                if key == tags and int(nanos) > start:
+                    result.append((EPOCH + timedelta(microseconds=int(nanos) // 1000),
+                                   float(field.split('=', 1)[1])))
+        return result
+
+
+STORAGE = {
+    'sqlite': SQLiteStorage,
+    'log': LogStorage,
+    'line': LineProtocolStorage,
+}
+
+
+def open_storage(spec, batch=1):
+    """Open a storage backend from a "kind:path" spec, e.g. "log:/tmp/boiler.log"."""
+    kind, _, path = spec.partition(':')
+    if kind not in STORAGE or not path:
+        raise ValueError('storage must be one of %s followed by :path, not %r' %
+                         (', '.join(sorted(STORAGE)), spec))
+    return STORAGE[kind](path, batch)
+
+
+BENCHMARK_BATCHES = (1, 100)
+
+
+def benchmark_storage(directory, count=10000, batches=BENCHMARK_BATCHES):
+    """Time ingest and query of count samples against every backend."""
+    start = datetime(2015, 1, 1)
+    samples = [sample(Storage.TABLES[i % 2], start + timedelta(seconds=10 * i), i // 2 % 2,
+                      20 + i % 100 * 0.0625)
+               for i in range(count)]
+    for kind in sorted(STORAGE):
+        for batch in batches:
+            path = os.path.join(directory, 'benchmark-%s-%d' % (kind, batch))
+            storage = open_storage('%s:%s' % (kind, path), batch)
+            begin = time()
+            for s in samples:
+                storage.write(s)
+            storage.flush()
+            ingest = time() - begin
+            begin = time()
+            rows = storage.query('temperature', 1, start + timedelta(seconds=10 * count // 2))
+            query = time() - begin
+            storage.close()
+            print('%-6s batch %4d: ingest %8.0f samples/s, query %5d rows in %.3fs, %d bytes on disk' %
+                  (kind, batch, count / ingest, len(rows), query, os.path.getsize(path)))
+            os.unlink(path)
+
+
+class DBWriter(object):
+    def __init__(self, storage, emoncms=EMONCMS_URL):
+        self.buf = defaultdict(deque)
+        self.storage = storage
+        self.emoncms = emoncms if requests is not None else None
+
+    def write(self, idx, value, date=None):
+        data = (date or datetime.now(), idx, value)
         line = "%s %d %f" % data
         if idx > 0:
             print('\033[%dC' % len(line) * idx, end='')
@@ -350,45 +1000,97 @@ class DBWriter(object):
         sys.stdout.flush()
         self.buf[idx].append(data)
         try:
-            self.cur.execute('insert into temperature_raw values (?, ?, ?)',
-                             data)
-            res = requests.post('http://emonpi/emoncms/input/post.json?node=1&apikey=74f0ab98df349fdfd17559978fb1d4b9',
-                          data={'data': json.dumps({'T{}raw'.format(idx): value})})
+            self.storage.write(sample('temperature_raw', *data))
+            if self.emoncms:
+                requests.post(self.emoncms, data={'data': json.dumps({'T{}raw'.format(idx): value})}, timeout=5)
             if len(self.buf[idx]) >= 21:
                 # Take the middle-ish value to use for the time.
                 data = (self.buf[idx][10][0], idx, tridian([x[2] for x in self.buf[idx]]))
                 self.buf[idx].popleft()
-                self.cur.execute('insert into temperature values (?, ?, ?)',
-                                 data)
-                requests.post('http://emonpi/emoncms/input/post.json?node=1&apikey=74f0ab98df349fdfd17559978fb1d4b9',
-                              data={'data': json.dumps({'T{}'.format(idx): value})})
-        except (requests.exceptions.ConnectionError, sqlite3.OperationalError) as exc:
+                self.storage.write(sample('temperature', *data))
+                if self.emoncms:
+                    requests.post(self.emoncms, data={'data': json.dumps({'T{}'.format(idx): value})}, timeout=5)
+        except (RequestException, sqlite3.OperationalError, EnvironmentError) as exc:
             print('\n', exc)
 
     def close(self):
-        self.con.commit()
-        self.cur.close()
-        self.con.close()
+        self.storage.close()
+
+
+def replay(path, storage):
+    """Run a recorded event log through a Controller and report throughput."""
+    with Controller(None, None, DBWriter(storage, emoncms=None), None,
+                    SimulatedRelay([15, 14]), None) as controller:
+        start = time()
+        events = list(EventLog.read(path))
+        count = controller.replay(events)
+        elapsed = time() - start
+    if events:
+        print('\nreplayed %d events (%d records) covering %.0fs in %.3fs: %.0f events/s' %
+              (count, len(events), events[-1][0] - events[0][0], elapsed, count / max(elapsed, 1e-9)))
+
+
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise ArgumentTypeError('must be at least 1')
+    return value
+
+
+def with_sensor_budget(budgets, phase, oversample):
+    """Extend a phase's budget by the time an oversampled read takes."""
+    budgets = dict(budgets)
+    budgets[phase] += oversample * Temperature.CONVERSION_TIME
+    return budgets
 
 
 def main():
-    GPIO.setmode(GPIO.BCM)
     parser = ArgumentParser()
-    parser.add_argument('--mode', required=True, choices=['boiler', 'controller'])
+    parser.add_argument('--mode', required=True, choices=['boiler', 'controller', 'benchmark', 'replay'])
     parser.add_argument('--pidfile',  '-p', default='/var/run/autoboiler.pid')
     parser.add_argument('--sock', '-s', default='/var/lib/autoboiler/autoboiler.socket')
     parser.add_argument('--output', '-o')
+    parser.add_argument('--oversample', type=positive_int, default=1,
+                        help='number of sensor reads to average into each sample')
+    parser.add_argument('--storage',
+                        help='where to store samples: sqlite:PATH, log:PATH or line:PATH '
+                             '(default sqlite:/var/lib/autoboiler/autoboiler.sqlite3 for the controller, '
+                             'none for the boiler)')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='number of samples to buffer before writing them to storage')
+    parser.add_argument('--min-on', type=float, default=30,
+                        help='boiler: seconds a relay must stay on before it may be turned off')
+    parser.add_argument('--min-off', type=float, default=30,
+                        help='boiler: seconds a relay must stay off before it may be turned on')
+    parser.add_argument('--events',
+                        help='controller: append every input to this event log; replay: the log to replay')
+    parser.add_argument('--failsafe', type=float, default=20,
+                        help='turn the relays off once the main loop is this many seconds past its '
+                             'deadline; keep %d plus this below WatchdogSec in autoboiler.service' % LOOP_DEADLINE)
     args = parser.parse_args()
+    hardware = args.mode in ('boiler', 'controller')
+    if not hardware:
+        args.pidfile = None
+    if hardware and None in (SpiDev, GPIO, NRF24):
+        parser.error('--mode %s needs the spidev, RPi.GPIO and nrf24 modules' % args.mode)
+    if args.mode == 'replay' and not args.events:
+        parser.error('--mode replay needs --events')
     if args.output:
         f = open(args.output, 'a+')
         if f:
             sys.stdout = f
+    if hardware:
+        GPIO.setmode(GPIO.BCM)
     if args.pidfile:
         with open(args.pidfile, 'w') as f:
             print(os.getpid(), file=f)
     try:
         if args.mode == 'boiler':
-            with Boiler(0, 0, 25, 24, Temperature(0, 1), Relay([17, 18]), Button([23, 24])) as radio:
+            relay = Relay([17, 18])
+            storage = open_storage(args.storage, args.batch) if args.storage else None
+            with Watchdog(with_sensor_budget(BOILER_BUDGETS, 'sensor', args.oversample), LOOP_DEADLINE, args.failsafe, relay) as watchdog, \
+                    Boiler(open_radio(0, 0, 25, 24), Temperature(0, 1, oversample=args.oversample), relay, Button([23, 24]), watchdog, storage,
+                           args.min_on, args.min_off) as radio:
                 radio.run()
         elif args.mode == 'controller':
             try:
@@ -401,10 +1103,24 @@ def main():
             os.chmod(args.sock, 0o777)
             sock.setblocking(0)
             sock.listen(1)
-            with Controller(0, 1, 25, 24, Temperature(0, 0), DBWriter(), sock, Relay([15, 14])) as radio:
+            relay = Relay([15, 14])
+            storage = open_storage(args.storage or 'sqlite:/var/lib/autoboiler/autoboiler.sqlite3', args.batch)
+            events = EventLog(args.events) if args.events else None
+            with Watchdog(with_sensor_budget(CONTROLLER_BUDGETS, 'actions', args.oversample), LOOP_DEADLINE, args.failsafe, relay) as watchdog, \
+                    Controller(open_radio(0, 1, 25, 24), Temperature(0, 0, oversample=args.oversample),
+                               DBWriter(storage), sock, relay, watchdog, events) as radio:
                 radio.run()
+        elif args.mode == 'benchmark':
+            directory = tempfile.mkdtemp(dir=os.path.dirname(args.storage.partition(':')[2]) if args.storage else None)
+            try:
+                benchmark_storage(directory, batches=sorted(set(BENCHMARK_BATCHES + (args.batch,))))
+            finally:
+                os.rmdir(directory)
+        elif args.mode == 'replay':
+            replay(args.events, open_storage(args.storage, args.batch) if args.storage else NullStorage(None))
     finally:
-        GPIO.cleanup()
+        if hardware:
+            GPIO.cleanup()
         if args.pidfile:
             os.unlink(args.pidfile)
         if args.sock and args.mode == 'controller':
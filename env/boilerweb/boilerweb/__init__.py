@@ -1,19 +1,25 @@
 from pyramid.config import Configurator
-from sqlalchemy import engine_from_config
 from pyramid.session import SignedCookieSessionFactory
 
 from .models import (
     DBSession,
     Base,
+    make_engine,
+    check_schema,
     )
+from .archive import Archive
 
 
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
-    engine = engine_from_config(settings, 'sqlalchemy.')
+    engine = make_engine(settings)
     DBSession.configure(bind=engine)
     Base.metadata.bind = engine
+    check_schema(engine)
+    archive = settings.get('boilerweb.archive', '').strip()
+    settings['boilerweb.archive'] = Archive(archive) if archive else None
+    settings['boilerweb.sensors'] = [int(s) for s in settings.get('boilerweb.sensors', '0 1').split()]
     config = Configurator(settings=settings)
     config.set_session_factory(SignedCookieSessionFactory('a scret phrase that noone will ever guess. oh.'))
     config.include('pyramid_chameleon')
@@ -0,0 +1,178 @@
+"""Columnar archive of historical temperature readings.
+
+Each sensor gets a directory of one file per calendar month.  A file is a
+16 byte header followed by ``count`` little-endian ``int64`` timestamps
+(microseconds since 1970-01-01 in the daemon's local time) and then
+``count`` ``float32`` temperatures.  Both columns are aligned so a reader can
+``mmap`` the file and view them as NumPy arrays without copying.  If the
+``DELTA`` flag is set the timestamps are stored as differences from the
+previous reading (the first is absolute), which compresses much better but
+costs a cumulative sum to decode.
+"""
+import os
+import struct
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import func
+
+from .models import (
+    DBSession,
+    temperature,
+    )
+
+MAGIC = b'ABAR'
+VERSION = 1
+DELTA = 1
+HEADER = struct.Struct('<4sBBxxQ')
+
+
+def to_micros(dates):
+    return np.array(dates, dtype='datetime64[us]').astype('<i8')
+
+
+def next_month(year, month):
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def write_month(path, timestamps, temperatures, delta=False):
+    """Atomically write one month of readings to ``path``."""
+    timestamps = np.asarray(timestamps, dtype='<i8')
+    temperatures = np.asarray(temperatures, dtype='<f4')
+    if len(timestamps) != len(temperatures):
+        raise ValueError('timestamps and temperatures differ in length')
+    if delta and len(timestamps):
+        stored = np.empty_like(timestamps)
+        stored[0] = timestamps[0]
+        stored[1:] = np.diff(timestamps)
+        timestamps = stored
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, DELTA if delta else 0, len(timestamps)))
+        timestamps.tofile(f)
+        temperatures.tofile(f)
+    os.rename(tmp, path)
+
+
+def read_month(path):
+    """Return (timestamps, temperatures) for an archive file.
+
+    Both arrays are read-only views of the mapped file, apart from the
+    timestamps of a delta-encoded file which have to be decoded.
+    """
+    with open(path, 'rb') as f:
+        magic, version, flags, count = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('%s is not a version %d archive file' % (path, VERSION))
+    data = np.memmap(path, mode='r')
+    if len(data) != HEADER.size + 12 * count:
+        raise ValueError('%s is truncated' % path)
+    timestamps = data[HEADER.size:HEADER.size + 8 * count].view('<i8')
+    temperatures = data[HEADER.size + 8 * count:].view('<f4')
+    if flags & DELTA:
+        timestamps = np.cumsum(timestamps)
+    return timestamps, temperatures
+
+
+class Archive(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, sensor, year, month):
+        return os.path.join(self.directory, str(sensor), '%04d-%02d.col' % (year, month))
+
+    def months(self, sensor):
+        """Return the sorted (year, month) pairs archived for a sensor."""
+        try:
+            names = os.listdir(os.path.join(self.directory, str(sensor)))
+        except OSError:
+            return []
+        return sorted(tuple(int(part) for part in name[:-4].split('-'))
+                      for name in names if name.endswith('.col'))
+
+    def end(self, sensor):
+        """Return the first datetime not covered by the archive, or None."""
+        months = self.months(sensor)
+        if not months:
+            return None
+        return datetime(*next_month(*months[-1]) + (1,))
+
+    def read(self, sensor, start, end=None):
+        """Return archived (timestamps, temperatures) with start < date < end."""
+        start = to_micros(start)
+        stop = to_micros(end) if end is not None else None
+        chunks = []
+        for year, month in self.months(sensor):
+            if to_micros(datetime(*next_month(year, month) + (1,))) <= start:
+                continue
+            if stop is not None and to_micros(datetime(year, month, 1)) >= stop:
+                break
+            timestamps, temperatures = read_month(self.path(sensor, year, month))
+            lo = timestamps.searchsorted(start, side='right')
+            hi = timestamps.searchsorted(stop) if stop is not None else len(timestamps)
+            chunks.append((timestamps[lo:hi], temperatures[lo:hi]))
+        if not chunks:
+            return np.empty(0, dtype='<i8'), np.empty(0, dtype='<f4')
+        if len(chunks) == 1:
+            return chunks[0]
+        return (np.concatenate([c[0] for c in chunks]),
+                np.concatenate([c[1] for c in chunks]))
+
+    def export(self, before=None, delta=False):
+        """Archive every complete month of the temperature table before ``before``.
+
+        ``before`` defaults to the start of the current month.  Months which
+        are already archived are skipped.  Returns the paths written.
+        """
+        if before is None:
+            now = datetime.now()
+            before = datetime(now.year, now.month, 1)
+        written = []
+        firsts = DBSession.query(temperature.sensor, func.min(temperature.date))\
+                          .group_by(temperature.sensor).all()
+        for sensor, first in firsts:
+            done = set(self.months(sensor))
+            year, month = first.year, first.month
+            while datetime(year, month, 1) < before:
+                following = next_month(year, month)
+                if (year, month) not in done:
+                    rows = DBSession.query(temperature.date, temperature.temperature)\
+                                    .filter(temperature.sensor == sensor)\
+                                    .filter(temperature.date >= datetime(year, month, 1))\
+                                    .filter(temperature.date < datetime(*following + (1,)))\
+                                    .order_by(temperature.date).all()
+                    if rows:
+                        path = self.path(sensor, year, month)
+                        if not os.path.isdir(os.path.dirname(path)):
+                            os.makedirs(os.path.dirname(path))
+                        write_month(path, to_micros([r.date for r in rows]),
+                                    [r.temperature for r in rows], delta)
+                        written.append(path)
+                year, month = following
+        return written
+
+
+def readings(archive, sensor, start):
+    """Return (timestamps, temperatures) for a sensor since ``start``.
+
+    Months covered by ``archive`` are read from it and anything newer from
+    the live temperature table, so callers see one continuous series.
+    ``archive`` may be None (or empty) to read only from the database.
+    """
+    live_start = start
+    chunks = []
+    if archive:
+        end = archive.end(sensor)
+        if end is not None and end > start:
+            chunks.append(archive.read(sensor, start, end))
+            live_start = end
+    rows = DBSession.query(temperature.date, temperature.temperature)\
+                    .filter(temperature.sensor == sensor)\
+                    .filter((temperature.date >= live_start) if chunks else (temperature.date > start))\
+                    .order_by(temperature.date).all()
+    chunks.append((to_micros([r.date for r in rows]),
+                   np.array([r.temperature for r in rows], dtype='<f4')))
+    if len(chunks) == 1 or not len(chunks[1][0]):
+        return chunks[0]
+    return (np.concatenate([c[0] for c in chunks]),
+            np.concatenate([c[1] for c in chunks]))
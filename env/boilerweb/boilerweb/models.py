@@ -1,12 +1,20 @@
+import logging
+import sqlite3
+
 from sqlalchemy import (
     Column,
     Index,
     Integer,
+    Float,
     Text,
     DateTime,
+    engine_from_config,
+    inspect,
     )
 
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
 
 from sqlalchemy.orm import (
     scoped_session,
@@ -15,6 +23,8 @@ from sqlalchemy.orm import (
 
 from zope.sqlalchemy import ZopeTransactionExtension
 
+log = logging.getLogger(__name__)
+
 DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
 Base = declarative_base()
 
@@ -24,11 +34,127 @@ class temperature(Base):
     rowid = Column(Integer, primary_key=True)
     date = Column(DateTime, nullable=False)
     sensor = Column(Integer, nullable=False)
-    temperature = Column(Integer, nullable=False)
+    temperature = Column(Float, nullable=False)
 
-Index('temperature_date', temperature.date, unique=True, mysql_length=255)
+# Same name and columns as the index autoboiler.py creates, so that
+# initialize_boilerweb_db and the daemon agree on the schema.
+Index('temperature_sensor_date', temperature.sensor, temperature.date)
 
 class channel(Base):
     __tablename__ = 'channel'
     id = Column(Integer, primary_key=True)
     name = Column(Text, nullable=False)
+
+
+# Tables written by autoboiler.py; check_schema() only compares these.
+DAEMON_TABLES = ('temperature',)
+
+
+def _connect_read_only(path):
+    """Open the daemon's database so that this process cannot write to it."""
+    uri = 'file:%s?mode=ro' % path.replace('%', '%25').replace('?', '%3f').replace('#', '%23')
+    try:
+        return sqlite3.connect(uri, uri=True, check_same_thread=False), True
+    except TypeError:  # Python 2's sqlite3 cannot open URIs.
+        return sqlite3.connect(path, check_same_thread=False), False
+
+
+def make_engine(settings, prefix='sqlalchemy.'):
+    """Build the engine for the web app from the ini settings.
+
+    SQLite databases are opened read-only through a ``mode=ro`` URI and get
+    a real connection pool (the default for a file database is to reconnect
+    on every checkout).  Each new connection is configured from the
+    ``sqlite.*`` settings: ``sqlite.query_only`` (default true) also sets
+    ``PRAGMA query_only``, which is always set where the Python cannot open
+    URIs; ``sqlite.mmap_size`` maps that many bytes of the file instead of
+    copying pages through the page cache; and ``sqlite.pool_size`` sets the
+    number of pooled connections.
+    """
+    url = make_url(settings[prefix + 'url'])
+    if not url.drivername.startswith('sqlite') or url.database in (None, '', ':memory:'):
+        return engine_from_config(settings, prefix)
+    query_only = settings.get('sqlite.query_only', 'true').lower() in ('true', 'yes', 'on', '1')
+    mmap_size = int(settings.get('sqlite.mmap_size', 64 * 1024 * 1024))
+
+    def connect():
+        connection, read_only = _connect_read_only(url.database)
+        cursor = connection.cursor()
+        try:
+            cursor.execute('PRAGMA mmap_size = %d' % mmap_size)
+            if query_only or not read_only:
+                cursor.execute('PRAGMA query_only = ON')
+        finally:
+            cursor.close()
+        return connection
+
+    return engine_from_config(settings, prefix,
+                              poolclass=QueuePool,
+                              pool_size=int(settings.get('sqlite.pool_size', 5)),
+                              creator=connect)
+
+
+def _python_type(type_):
+    try:
+        return type_.python_type
+    except NotImplementedError:
+        return None
+
+
+def check_schema(engine):
+    """Compare the models of the daemon's tables against the database.
+
+    Returns a list of human readable problems, empty if the models match.
+    Missing tables are reported but otherwise ignored, since a fresh
+    database may not have been initialised yet.
+    """
+    problems = []
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    for table in (Base.metadata.tables[name] for name in DAEMON_TABLES):
+        if table.name not in tables:
+            problems.append('table %s does not exist' % table.name)
+            continue
+        columns = dict((c['name'], c) for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name == 'rowid' and 'rowid' not in columns:
+                continue  # SQLite's implicit rowid is never reflected.
+            if column.name not in columns:
+                problems.append('column %s.%s does not exist' % (table.name, column.name))
+                continue
+            expected = _python_type(column.type)
+            found = _python_type(columns[column.name]['type'])
+            if expected is not None and found is not None and expected is not found:
+                problems.append('column %s.%s is %s in the database but %s in the model' %
+                                (table.name, column.name,
+                                 columns[column.name]['type'], column.type))
+        indexes = dict((i['name'], i) for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                problems.append('index %s does not exist' % index.name)
+            elif [c.name for c in index.columns] != list(indexes[index.name]['column_names']):
+                problems.append('index %s is on (%s) in the database but (%s) in the model' %
+                                (index.name, ', '.join(indexes[index.name]['column_names']),
+                                 ', '.join(c.name for c in index.columns)))
+    for problem in problems:
+        log.warning('schema drift: %s', problem)
+    return problems
+
+
+def latest_readings(sensors):
+    """Return a dict of sensor => most recent temperature row.
+
+    All sensors are fetched in one statement.  Each sensor's latest rowid is
+    found by a descending walk of the (sensor, date) index which stops after
+    one entry, so the cost does not grow with the size of the table.
+    """
+    latest = [DBSession.query(temperature.rowid)
+                       .filter(temperature.sensor == sensor)
+                       .order_by(temperature.date.desc())
+                       .limit(1)
+                       .as_scalar()
+              for sensor in sensors]
+    if not latest:
+        return {}
+    rows = DBSession.query(temperature).filter(temperature.rowid.in_(latest)).all()
+    return dict((row.sensor, row) for row in rows)
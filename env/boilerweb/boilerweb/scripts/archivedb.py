@@ -0,0 +1,40 @@
+import os
+import sys
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from pyramid.scripts.common import parse_vars
+
+from ..models import (
+    DBSession,
+    make_engine,
+    )
+from ..archive import Archive
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [var=value]\n'
+          '(example: "%s development.ini boilerweb.archive_delta=true")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri, options=options)
+    if not settings.get('boilerweb.archive'):
+        print('boilerweb.archive is not set in %s' % config_uri)
+        sys.exit(1)
+    engine = make_engine(settings)
+    DBSession.configure(bind=engine)
+    archive = Archive(settings['boilerweb.archive'])
+    delta = settings.get('boilerweb.archive_delta', 'false').lower() in ('true', 'yes', 'on', '1')
+    for path in archive.export(delta=delta):
+        print(path)
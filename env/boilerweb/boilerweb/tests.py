@@ -52,4 +52,114 @@ class TestMyViewFailureCondition(unittest.TestCase):
         from .views import my_view
         request = testing.DummyRequest()
         info = my_view(request)
-        self.assertEqual(info.status_int, 500)
\ No newline at end of file
+        self.assertEqual(info.status_int, 500)
+
+class TestLatestReadings(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+        from sqlalchemy import create_engine
+        self.engine = create_engine('sqlite://')
+        from .models import (
+            Base,
+            temperature,
+            )
+        from datetime import datetime
+        DBSession.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+        with transaction.manager:
+            for minute, sensor, value in [(0, 0, 18.5), (1, 0, 19.25),
+                                          (0, 1, 40.0), (2, 1, 42.5)]:
+                DBSession.add(temperature(date=datetime(2015, 1, 1, 12, minute),
+                                          sensor=sensor, temperature=value))
+
+    def tearDown(self):
+        DBSession.remove()
+        testing.tearDown()
+
+    def test_latest_per_sensor(self):
+        from .models import latest_readings
+        latest = latest_readings([0, 1, 2])
+        self.assertEqual(sorted(latest), [0, 1])
+        self.assertEqual(latest[0].temperature, 19.25)
+        self.assertEqual(latest[1].temperature, 42.5)
+
+    def test_schema_matches_models(self):
+        from .models import check_schema
+        self.assertEqual(check_schema(self.engine), [])
+
+    def test_schema_drift(self):
+        from .models import check_schema
+        self.engine.execute('DROP INDEX temperature_sensor_date')
+        self.engine.execute('CREATE INDEX temperature_sensor_date ON temperature(date)')
+        self.assertEqual(len(check_schema(self.engine)), 1)
+
+
+class TestDaemonDatabase(unittest.TestCase):
+    def setUp(self):
+        import os
+        import sqlite3
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'autoboiler.sqlite3')
+        con = sqlite3.connect(self.path)
+        # The schema autoboiler.py creates; it has no channel table.
+        con.execute('''CREATE TABLE temperature
+                       (date datetime, sensor integer, temperature real)''')
+        con.execute('''CREATE INDEX temperature_sensor_date
+                       ON temperature(sensor, date)''')
+        con.commit()
+        con.close()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def test_no_drift_against_daemon_schema(self):
+        from .models import check_schema, make_engine
+        engine = make_engine({'sqlalchemy.url': 'sqlite:///' + self.path})
+        self.assertEqual(check_schema(engine), [])
+
+    def test_cannot_write(self):
+        from sqlalchemy.exc import OperationalError
+        from .models import make_engine
+        engine = make_engine({'sqlalchemy.url': 'sqlite:///' + self.path,
+                              'sqlite.query_only': 'false'})
+        self.assertRaises(OperationalError, engine.execute,
+                          "insert into temperature values ('2015-01-01', 0, 20.0)")
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        import os
+        from .archive import write_month, read_month
+        timestamps = [1420113600000000 + i * 10000000 for i in range(100)]
+        temperatures = [20 + i * 0.0625 for i in range(100)]
+        for delta in (False, True):
+            path = os.path.join(self.directory, 'month.col')
+            write_month(path, timestamps, temperatures, delta)
+            got_timestamps, got_temperatures = read_month(path)
+            self.assertEqual(list(got_timestamps), timestamps)
+            self.assertEqual(list(got_temperatures), temperatures)
+
+    def test_read_slices_months(self):
+        from datetime import datetime
+        from .archive import Archive, to_micros, write_month
+        import os
+        archive = Archive(self.directory)
+        os.makedirs(os.path.dirname(archive.path(0, 2015, 1)))
+        for month in (1, 2):
+            dates = [datetime(2015, month, day) for day in range(1, 29)]
+            write_month(archive.path(0, 2015, month), to_micros(dates),
+                        [float(month)] * len(dates))
+        self.assertEqual(archive.end(0), datetime(2015, 3, 1))
+        timestamps, temperatures = archive.read(0, datetime(2015, 1, 27),
+                                                datetime(2015, 2, 3))
+        self.assertEqual(list(temperatures), [1.0, 2.0, 2.0])
@@ -7,28 +7,32 @@ from sqlalchemy.exc import DBAPIError
 
 from .models import (
     DBSession,
-    temperature,
     channel,
+    latest_readings,
     )
+from .archive import readings
 
 from datetime import datetime, timedelta
 import StringIO
 import socket
 from contextlib import closing
+import numpy as np
 import matplotlib
 matplotlib.use('Agg')
+import matplotlib.dates
 import matplotlib.pyplot as plot
 
+EPOCH = datetime(1970, 1, 1)
+
 
 @view_config(route_name='home', renderer='templates/home.pt')
 def my_view(request):
     try:
-        zero = DBSession.query(temperature).filter(temperature.sensor == 0).order_by(temperature.date.desc()).first()
-        one = DBSession.query(temperature).filter(temperature.sensor == 1).order_by(temperature.date.desc()).first()
+        latest = latest_readings(request.registry.settings.get('boilerweb.sensors', (0, 1)))
     except DBAPIError as e:
         print e
         return Response(conn_err_msg, content_type='text/plain', status_int=500)
-    return {'zero': zero, 'one': one, 'project': 'boilerweb'}
+    return {'zero': latest.get(0), 'one': latest.get(1), 'project': 'boilerweb'}
 
 
 @view_config(route_name='queryactions')
@@ -110,28 +114,22 @@ def post_control_view(request):
 
 
 def index_min(values):
-    return min(range(len(values)), key=values.__getitem__)
+    return int(np.argmin(values))
 
 
 def index_max(values):
-    return max(range(len(values)), key=values.__getitem__)
+    return int(np.argmax(values))
 
 
 def plot_data(request, ax, sensor):
     start_time = datetime.now() - timedelta(days=float(request.params.get('days', 1)))
-    data = DBSession.query(temperature.date, temperature.temperature)\
-                    .filter(temperature.sensor == sensor)\
-                    .filter(temperature.date > start_time)\
-                    .order_by(temperature.date).all()
-    data0 = []
-    x = []
-    for d in data:
-        data0.append(d.temperature)
-        x.append(d.date)
+    timestamps, data0 = readings(request.registry.settings.get('boilerweb.archive'),
+                                 sensor, start_time)
     if len(data0) == 0:  # Still no data, there really is nothing to draw
         return
+    x = timestamps / 86400e6 + matplotlib.dates.date2num(EPOCH)
     line_colours = ['r-', 'b-', 'g-']
-    ax.plot_date(matplotlib.dates.date2num(x), data0, line_colours[sensor], xdate=True)
+    ax.plot_date(x, data0, line_colours[sensor], xdate=True)
     ax.text(x[0], data0[0], u'%2.1f°C' % data0[0])
     ax.text(x[-1], data0[-1], u'%2.1f°C' % data0[-1])
     maxtemp = index_max(data0)
@@ -17,6 +17,7 @@ requires = [
     'transaction',
     'zope.sqlalchemy',
     'waitress',
+    'numpy',
     ]
 
 setup(name='boilerweb',
@@ -43,5 +44,6 @@ setup(name='boilerweb',
       main = boilerweb:main
       [console_scripts]
       initialize_boilerweb_db = boilerweb.scripts.initializedb:main
+      archive_boilerweb_db = boilerweb.scripts.archivedb:main
       """,
       )
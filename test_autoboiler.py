@@ -0,0 +1,412 @@
+import errno
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from time import sleep
+
+import autoboiler
+
+
+class FakeClock(object):
+    def __init__(self, now=1420113600.0, step=3):
+        self.now = now
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+class FakeRadio(object):
+    last_error = None
+
+    def __init__(self):
+        self.writes = 0
+
+    def write(self, buf):
+        self.writes += 1
+        return self.writes % 3 != 0  # drop every third ACK
+
+    def startListening(self):
+        pass
+
+    def stopListening(self):
+        pass
+
+    def available(self, pipe):
+        return True
+
+    def read(self, buf):
+        buf.append(1)
+
+    def end(self):
+        pass
+
+
+class FakeTemperature(object):
+    def __init__(self):
+        self.value = 20.0
+
+    def read(self):
+        self.value += 0.5
+        return self.value
+
+    def cleanup(self):
+        pass
+
+
+class FakeDB(object):
+    def __init__(self):
+        self.rows = []
+
+    def write(self, idx, value, date=None):
+        self.rows.append((idx, value, date))
+
+    def close(self):
+        pass
+
+
+class SleepClock(object):
+    """A clock that only moves when something sleeps."""
+    def __init__(self, now=1420113600.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeSpi(object):
+    """Returns the given sensor counts in turn, recording when each was read."""
+    def __init__(self, clock, counts):
+        self.clock = clock
+        self.counts = list(counts)
+        self.reads = []
+
+    def open(self, major, minor):
+        pass
+
+    def xfer2(self, tx):
+        self.reads.append(self.clock.now)
+        count = self.counts.pop(0)
+        return [count >> 5 & 0xff, count << 3 & 0xff]
+
+    def close(self):
+        pass
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'events')
+        self.live = autoboiler.Controller(FakeRadio(), FakeTemperature(), FakeDB(), None,
+                                          autoboiler.SimulatedRelay([15, 14]), None,
+                                          autoboiler.EventLog(self.path), FakeClock())
+        EventLog = autoboiler.EventLog
+        self.live.dispatch(EventLog.START)
+        for i in range(100):
+            self.live.dispatch(EventLog.RADIO, b'\x0a\x00')
+            self.live.dispatch(EventLog.TIMER)
+            if i % 20 == 3:
+                self.live.dispatch(EventLog.COMMAND, b'boost 0 temp %d\n' % (30 + i))
+            if i % 20 == 4:
+                self.live.dispatch(EventLog.COMMAND, b'query 0\n')
+            if i % 20 == 5:
+                self.live.dispatch(EventLog.COMMAND, b'boost -1 time 40\n')
+        self.live.cleanup()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def replayer(self):
+        return autoboiler.Controller(None, None, FakeDB(), None,
+                                     autoboiler.SimulatedRelay([15, 14]), None)
+
+    def test_round_trip(self):
+        replayed = self.replayer()
+        replayed.replay(autoboiler.EventLog.read(self.path))
+        self.assertEqual(replayed.db.rows, self.live.db.rows)
+        self.assertEqual(replayed.actions, self.live.actions)
+        self.assertEqual(replayed.relay.states, self.live.relay.states)
+        self.assertEqual(replayed.temp, self.live.temp)
+
+    def test_scheduling_change_is_detected(self):
+        replayed = self.replayer()
+        replayed.SAMPLE_INTERVAL = 0
+        self.assertRaises(autoboiler.ReplayError, replayed.replay,
+                          autoboiler.EventLog.read(self.path))
+
+
+class CountingRelay(autoboiler.SimulatedRelay):
+    def __init__(self, pins):
+        autoboiler.SimulatedRelay.__init__(self, pins)
+        self.outputs = []
+
+    def output(self, pin, state):
+        self.outputs.append((pin, state))
+        autoboiler.SimulatedRelay.output(self, pin, state)
+
+
+class TestRelayCommands(unittest.TestCase):
+    def setUp(self):
+        self.relay = CountingRelay([17, 18])
+        self.commands = autoboiler.RelayCommands(self.relay, min_on=30, min_off=10)
+
+    def test_burst_ending_in_current_state_is_not_output(self):
+        for state in (1, 0, 1, 0):
+            self.commands.submit(0, state)
+        self.commands.apply()
+        self.assertEqual(self.relay.outputs, [])
+        self.assertEqual(self.commands.pending, {})
+
+    def test_burst_is_coalesced(self):
+        for state in (1, 0, 1, 1, 0, 1):
+            self.commands.submit(0, state)
+        self.commands.apply()
+        self.assertEqual(self.relay.outputs, [(0, True)])
+
+    def test_change_waits_for_min_on(self):
+        self.commands.submit(0, 1)
+        self.commands.apply()
+        changed = self.relay.changed[0]
+        self.commands.submit(0, 0)
+        self.commands.apply(now=changed + 29)
+        self.assertEqual(self.relay.state(0), True)
+        self.assertEqual(self.commands.state(0), 0)
+        self.commands.apply(now=changed + 30)
+        self.assertEqual(self.relay.state(0), False)
+        self.assertEqual(self.relay.outputs, [(0, True), (0, False)])
+
+    def test_change_waits_for_min_off(self):
+        self.commands.submit(0, 1)
+        self.commands.apply()
+        self.commands.submit(0, 0)
+        self.commands.apply(now=self.relay.changed[0] + 30)
+        changed = self.relay.changed[0]
+        self.commands.submit(0, 1)
+        self.commands.apply(now=changed + 9)
+        self.assertEqual(self.relay.state(0), False)
+        self.commands.apply(now=changed + 10)
+        self.assertEqual(self.relay.state(0), True)
+
+    def test_failsafe_counts_toward_dwell(self):
+        self.commands.submit(0, 1)
+        self.commands.apply()
+        watchdog = autoboiler.Watchdog({}, 30, 20, self.relay)
+        watchdog.fail_safe()
+        self.assertEqual(self.relay.state(0), False)
+        changed = self.relay.changed[0]
+        self.commands.submit(0, 1)
+        self.commands.apply(now=changed + 5)
+        self.assertEqual(self.relay.state(0), False)
+        self.commands.apply(now=changed + 10)
+        self.assertEqual(self.relay.state(0), True)
+
+    def test_failsafe_cancels_pending(self):
+        self.commands.submit(1, 1)
+        self.commands.apply(now=5)  # held by min_off
+        self.assertEqual(self.commands.pending, {1: True})
+        watchdog = autoboiler.Watchdog({}, 30, 20, self.relay)
+        watchdog.on_trip.append(self.commands.cancel)
+        watchdog.fail_safe()
+        self.assertEqual(self.commands.pending, {})
+        self.commands.apply(now=100)
+        self.assertEqual(self.relay.state(1), False)
+        self.assertEqual(self.commands.state(1), 0)
+
+
+class TestTemperature(unittest.TestCase):
+    def setUp(self):
+        self.clock = SleepClock()
+        self.time, self.sleep = autoboiler.time, autoboiler.sleep
+        autoboiler.time, autoboiler.sleep = self.clock.time, self.clock.sleep
+
+    def tearDown(self):
+        autoboiler.time, autoboiler.sleep = self.time, self.sleep
+
+    def sensor(self, counts, **kwargs):
+        self.spi = FakeSpi(self.clock, counts)
+        return autoboiler.Temperature(spi=self.spi, **kwargs)
+
+    def test_sample_is_cached_for_period(self):
+        temperature = self.sensor([320, 336], period=10)
+        self.assertEqual(temperature.sample(), 20.0)
+        self.clock.sleep(9.9)
+        self.assertEqual(temperature.sample(), 20.0)
+        self.clock.sleep(0.1)
+        self.assertEqual(temperature.sample(), 21.0)
+        self.assertEqual(len(self.spi.reads), 2)
+
+    def test_reads_are_spaced_by_conversion_time(self):
+        temperature = self.sensor([320] * 6, oversample=3, conversion_time=0.25)
+        temperature.sample()
+        temperature.sample()
+        start = self.spi.reads[0]
+        self.assertEqual([t - start for t in self.spi.reads],
+                         [0, 0.25, 0.5, 0.75, 1.0, 1.25])
+
+    def test_oversample_averages_counts(self):
+        temperature = self.sensor([320, 321, 321, 322], oversample=4)
+        self.assertEqual(temperature.sample(), 321 * 0.0625)
+        temperature = self.sensor([320, 321], oversample=2)  # 320.5 rounds up
+        self.assertEqual(temperature.sample(), 321 * 0.0625)
+
+    def test_raw_matches_value(self):
+        temperature = self.sensor([400, 401, 401], oversample=3)
+        self.assertEqual(temperature.rawread(), [0x0c, 0x88])
+        self.assertEqual(autoboiler.Temperature.calc_temp(temperature.raw),
+                         temperature.value)
+
+
+class TestStorage(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.start = datetime(2015, 1, 1)
+        self.samples = [autoboiler.sample(autoboiler.Storage.TABLES[i % 2],
+                                          self.start + timedelta(seconds=10 * i), i // 2 % 2,
+                                          20 + i * 0.5)
+                        for i in range(20)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open(self, kind, batch=3):
+        return autoboiler.open_storage('%s:%s' % (kind, os.path.join(self.directory, kind)), batch)
+
+    def expected(self, table, sensor, start):
+        return [(s.date, s.temperature) for s in self.samples
+                if s.table == table and s.sensor == sensor and s.date > start]
+
+    def test_round_trip(self):
+        for kind in sorted(autoboiler.STORAGE):
+            storage = self.open(kind)
+            for s in self.samples:
+                storage.write(s)
+            for table in autoboiler.Storage.TABLES:
+                for sensor in (0, 1):
+                    self.assertEqual(storage.query(table, sensor, self.start + timedelta(seconds=55)),
+                                     self.expected(table, sensor, self.start + timedelta(seconds=55)),
+                                     kind)
+            storage.close()
+
+    def test_open_storage_rejects_bad_specs(self):
+        for spec in ('sqlite', 'sqlite:', 'csv:/tmp/x', ''):
+            self.assertRaises(ValueError, autoboiler.open_storage, spec)
+
+    def test_locked_database_is_retried(self):
+        storage = self.open('sqlite', batch=1)
+        storage.cur.execute('PRAGMA busy_timeout = 0')
+        other = sqlite3.connect(storage.path, isolation_level=None)
+        other.execute('BEGIN EXCLUSIVE')
+        self.assertRaises(sqlite3.OperationalError, storage.write, self.samples[1])
+        other.execute('COMMIT')
+        # A reader holding a shared lock makes the COMMIT itself fail.
+        other.execute('BEGIN')
+        other.execute('select * from temperature').fetchall()
+        self.assertRaises(sqlite3.OperationalError, storage.write, self.samples[3])
+        other.execute('COMMIT')
+        other.close()
+        self.assertEqual(len(storage.pending), 2)
+        storage.write(self.samples[5])
+        self.assertEqual(storage.pending, [])
+        written = storage.query('temperature', 0, self.start) + \
+            storage.query('temperature', 1, self.start)
+        self.assertEqual(sorted(written),
+                         [(s.date, s.temperature) for s in self.samples[1:7:2]])
+        storage.close()
+
+    def test_pending_is_capped(self):
+        storage = self.open('sqlite', batch=1)
+        storage.MAX_PENDING = 4
+        storage.cur.execute('PRAGMA busy_timeout = 0')
+        other = sqlite3.connect(storage.path, isolation_level=None)
+        other.execute('BEGIN EXCLUSIVE')
+        for s in self.samples[:10]:
+            self.assertRaises(sqlite3.OperationalError, storage.write, s)
+        other.execute('COMMIT')
+        other.close()
+        self.assertEqual(storage.pending, self.samples[6:10])
+        storage.close()
+
+    def test_failed_append_is_truncated(self):
+        for kind in ('log', 'line'):
+            storage = self.open(kind, batch=4)
+            for s in self.samples[:4]:
+                storage.write(s)
+            size = os.path.getsize(storage.path)
+            write = autoboiler.os.write
+
+            def short_write(fd, data):
+                write(fd, data[:len(data) // 2])
+                raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+            autoboiler.os.write = short_write
+            try:
+                for s in self.samples[4:7]:
+                    storage.write(s)
+                self.assertRaises(OSError, storage.write, self.samples[7])
+            finally:
+                autoboiler.os.write = write
+            self.assertEqual(os.path.getsize(storage.path), size, kind)
+            for s in self.samples[8:]:
+                storage.write(s)
+            for table in autoboiler.Storage.TABLES:
+                self.assertEqual(storage.query(table, 1, self.start),
+                                 self.expected(table, 1, self.start), kind)
+            storage.close()
+
+
+class TestWatchdog(unittest.TestCase):
+    def setUp(self):
+        self.time = autoboiler.time
+        self.relay = CountingRelay([17, 18])
+
+    def tearDown(self):
+        autoboiler.time = self.time
+
+    def test_phase_histogram_and_overruns(self):
+        autoboiler.time = FakeClock(step=0.5)
+        watchdog = autoboiler.Watchdog({'slow': 0.25, 'fast': 1}, 30, 20)
+        for i in range(3):
+            with watchdog.phase('slow'):
+                pass
+            with watchdog.phase('fast'):
+                pass
+        with watchdog.phase('unbudgeted'):
+            pass
+        self.assertEqual(watchdog.overruns, {'slow': 3})
+        self.assertEqual(sum(watchdog.histograms['slow']), 3)
+        self.assertEqual(watchdog.histograms['fast'][9], 3)  # 0.256s < 0.5s <= 0.512s
+        self.assertEqual(watchdog.maxima['unbudgeted'], 0.5)
+
+    def test_report(self):
+        watchdog = autoboiler.Watchdog({'sensor': 1}, 30, 20)
+        watchdog.record('sensor', 0.0015)
+        watchdog.record('sensor', 0.0015)
+        watchdog.record('sensor', 100)
+        watchdog.overruns['sensor'] += 1
+        self.assertEqual(watchdog.report(),
+                         'sensor n=3 max=100.000s overruns=1 <0.002s:2 <infs:1')
+
+    def test_missed_deadline_turns_relays_off(self):
+        for pin in range(len(self.relay.pins)):
+            self.relay.output(pin, True)
+        watchdog = autoboiler.Watchdog({}, deadline=0.05, failsafe=0.05, relay=self.relay)
+        watchdog.POLL_INTERVAL = 0.01
+        with watchdog:
+            for i in range(200):
+                if watchdog.tripped:
+                    break
+                sleep(0.01)
+            self.assertTrue(watchdog.tripped)
+            self.assertEqual(self.relay.states, [False, False])
+            watchdog.kick()
+            self.assertFalse(watchdog.tripped)
+
+
+if __name__ == '__main__':
+    unittest.main()